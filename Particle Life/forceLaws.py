@@ -0,0 +1,68 @@
+import numpy as np
+from numba import njit
+
+# ---------------------------------------------------------------------------------
+# Force laws
+#
+# A force law is a Numba function 'law(dist, R_min, R_max, alpha)' which returns the
+# force a particle feels from a neighbour at distance 'dist'. Every law gets its own
+# compiled copy of the physics kernels (see particleManager.compile_force_law) so
+# there is no branching or indirect call in the inner loop.
+
+@njit(cache=True)
+def calculate_force(dist, R_min, R_max, alpha):
+
+    # Piece-wise function:
+    # - Repels particles if dist < R_min.
+    # - Attracts/Repels if R_min < dist < R_max.
+    # - Returns 0 otherwise.
+
+    if dist < R_min:
+        return alpha * (1.0 - dist / R_min)
+    elif dist < R_max:
+
+        # We use the sinoid version because its smoother then using ABS which creates
+        # a very pointy and pyramid like shape. Off course this is just a preference with
+        # no real value except smoother movement.
+
+        normalized_dist = (dist - R_min) / (R_max - R_min)
+        return alpha * np.sin(np.pi * normalized_dist)
+
+    return 0.0
+
+@njit(cache=True)
+def triangle_force(dist, R_min, R_max, alpha):
+
+    # The ABS version, same repulsion as calculate_force but a linear
+    # 'triangle' between R_min and R_max which peaks halfway
+
+    if dist < R_min:
+        return alpha * (1.0 - dist / R_min)
+    elif dist < R_max:
+        normalized_dist = (dist - R_min) / (R_max - R_min)
+        return alpha * (1.0 - np.abs(2.0 * normalized_dist - 1.0))
+
+    return 0.0
+
+
+class ForceLaw:
+    # A registered force law. With 'pair_radii' the law gets R_min and R_max
+    # per type pair (ParticleManager.pair_radii) instead of the global radii
+    def __init__(self, name, function, pair_radii=False):
+        self.name = name
+        self.function = function
+        self.pair_radii = pair_radii
+
+
+FORCE_LAWS = {}
+
+def register_force_law(name, function, pair_radii=False):
+    # Adds a force law to the registry. The function has to be defined at module level
+    # (a Numba function or a plain Python function which then gets compiled)
+    FORCE_LAWS[name] = ForceLaw(name, function, pair_radii)
+    return FORCE_LAWS[name]
+
+
+register_force_law("sine", calculate_force)
+register_force_law("triangle", triangle_force)
+register_force_law("pair_radii", calculate_force, pair_radii=True)
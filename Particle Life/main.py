@@ -1,14 +1,32 @@
+import sys
 import numpy as np
 from simulation import Simulation
+from server import StreamServer
+from threadControl import configure_threading
+from scaling import scaling_report
 
 # Simulation related variables
 PARTICLE_COUNT         = 17000
+PARTICLE_CAPACITY      = 25000
 NUMBER_OF_TYPES        = 6
 INITIAL_SEED           = 42
 FRICTION               = 0.4
 MAX_SPEED              = 1000
 DELTA_TIME             = 0.1
 
+# Adaptive timestep, splits a frame into substeps when particles move
+# more than MAX_CELL_FRACTION of a cell in a single step. The substeps are
+# picked from the previous frame (and raised for the rest of a frame when
+# velocities spike), so the substep where a spike happens can still overshoot
+ADAPTIVE_TIMESTEP      = True
+MAX_CELL_FRACTION      = 0.5
+MAX_SUBSTEPS           = 8
+
+# In-kernel analytics (kinetic energy per type, cell occupancy and
+# pair distance histogram with RDF_BINS bins up to MAX_ATTRACTION_RADIUS)
+ANALYTICS              = False
+RDF_BINS               = 32
+
 
 # Spatial variables - (KEEP MAP SIZE 300 (or not and maybe mess up the UI))
 MAP_SIZE               = 300
@@ -16,6 +34,31 @@ MIN_ATTRACTION_RADIUS  = 3
 MAX_ATTRACTION_RADIUS  = 20
 CELL_SIZE              = MAX_ATTRACTION_RADIUS 
 
+# The force law, one of the registered laws in forceLaws.py
+# ("sine", "triangle", "pair_radii" or your own with register_force_law)
+FORCE_LAW              = "sine"
+
+# Far-field approximation for large attraction radii. The grid is split
+# FAR_FIELD_SUBDIVISIONS times finer and distant cells are approximated,
+# a lower FAR_FIELD_THETA is more accurate (0 is exact)
+FAR_FIELD              = False
+FAR_FIELD_SUBDIVISIONS = 4
+FAR_FIELD_THETA        = 0.5
+
+# Threads for the Numba kernels (0 is all cores) and the Numba threading layer
+# ("default" lets Numba choose, "tbb", "omp", "workqueue", ...). 'python main.py --scaling' prints
+# a strong/weak scaling report of the physics for 1..all threads
+PHYSICS_THREADS        = 0
+RENDER_THREADS         = 0
+THREADING_LAYER        = "default"
+
+# Server mode, runs without a window and streams the frames to remote
+# viewers (python viewer.py). Can also be enabled with 'python main.py --server'
+SERVER_MODE            = False
+SERVER_HOST            = "127.0.0.1"
+SERVER_PORT            = 5555
+SERVER_MAX_FPS         = 60
+
 # Display setting (DO NOT CHANGE)
 SIDEBAR_WIDTH          = 500 
 TOTAL_SCREEN_WIDTH     = MAP_SIZE * 2 + SIDEBAR_WIDTH
@@ -29,6 +72,7 @@ def main():
     # our code cleaner
     config = {
         "particle_count":    PARTICLE_COUNT,
+        "particle_capacity": PARTICLE_CAPACITY,
         "map_size":          MAP_SIZE,
         "min_r":             MIN_ATTRACTION_RADIUS,
         "max_r":             MAX_ATTRACTION_RADIUS,
@@ -41,12 +85,35 @@ def main():
         "friction":          FRICTION,
         "delta_time":        DELTA_TIME,
         "max_speed":         MAX_SPEED,
+        "adaptive":          ADAPTIVE_TIMESTEP,
+        "max_cell_fraction": MAX_CELL_FRACTION,
+        "max_substeps":      MAX_SUBSTEPS,
+        "analytics":         ANALYTICS,
+        "rdf_bins":          RDF_BINS,
+        "far_field":         FAR_FIELD,
+        "far_field_subdivisions": FAR_FIELD_SUBDIVISIONS,
+        "far_field_theta":   FAR_FIELD_THETA,
+        "force_law":         FORCE_LAW,
+        "physics_threads":   PHYSICS_THREADS,
+        "render_threads":    RENDER_THREADS,
+        "server_host":       SERVER_HOST,
+        "server_port":       SERVER_PORT,
+        "server_max_fps":    SERVER_MAX_FPS,
         "buffer_clear":      BUFFER_CLEAR
     }
 
+    # Has to happen before the first parallel kernel runs
+    configure_threading(THREADING_LAYER)
+
     # Initialize and run
-    sim = Simulation(**config)
-    sim.run()
+    if "--scaling" in sys.argv:
+        scaling_report(config)
+    elif SERVER_MODE or "--server" in sys.argv:
+        server = StreamServer(**config)
+        server.run()
+    else:
+        sim = Simulation(**config)
+        sim.run()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
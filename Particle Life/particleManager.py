@@ -1,50 +1,70 @@
+import hashlib
+import importlib.util
+import inspect
+import os
+import sys
 import numpy as np
-from numba import njit, int32, float64, prange
-
-#
+from numba import njit, int32, float64, prange, config, get_thread_id
+from numba.misc.appdirs import user_cache_dir
+from forceLaws import calculate_force, FORCE_LAWS
+from threadControl import use_threads
 
 @njit(cache=True)
-def calculate_force(dist, R_min, R_max, alpha):
-    
-    # Piece-wise function:
-    # - Repels particles if dist < R_min.
-    # - Attracts/Repels if R_min < dist < R_max.
-    # - Returns 0 otherwise.
+def integrate_particle(positions, velocities, i, pos_x, pos_y, f_x, f_y, friction, dt, max_speed, map_size):
+
+    # Integrates a single particle with the accumulated force and returns its new velocity
     
-    if dist < R_min:
-        return alpha * (1.0 - dist / R_min)
-    elif dist < R_max:
+    vx = (velocities[i, 0] + f_x * dt) * friction
+    vy = (velocities[i, 1] + f_y * dt) * friction
 
-        # We use the sinoid version because its smoother then using ABS which creates
-        # a very pointy and pyramid like shape. Off course this is just a preference with
-        # no real value except smoother movement. 
+    # Limit speeed 
+   
+    speed_sq = vx**2 + vy**2
+    if speed_sq > max_speed**2:
+        scale = max_speed / np.sqrt(speed_sq)
+        vx *= scale
+        vy *= scale
 
-        normalized_dist = (dist - R_min) / (R_max - R_min)
-        return alpha * np.sin(np.pi * normalized_dist)
-    
-    return 0.0
+    velocities[i, 0], velocities[i, 1] = vx, vy
+
+    # Update position with tordial wrapping
+    positions[i, 0] = (pos_x + vx * dt) % map_size
+    positions[i, 1] = (pos_y + vy * dt) % map_size
+    return vx, vy
 
-@njit(parallel=True, cache=True)
+@njit(parallel=True, cache=True, nogil=True)
 def update_particles(
     positions, velocities, types, N, R_min, R_max, matrix, 
-    friction, dt, max_speed, map_size, grid_pos, grid_counts, cell_size, grid_dim
+    friction, dt, max_speed, map_size, grid_pos, grid_counts, cell_size, grid_dim,
+    analytics, energy_acc, pair_acc, pair_radii
 ):
     # Main simulation step: Spatial hashing lookup + Force accumulation + Integration
     # Boundary threshold for wrapping logic
 
+    # When 'analytics' is set we also fill the per-thread accumulators (indexed by
+    # the thread id so no two threads write to the same row):
+    # - energy_acc[thread, type]           kinetic energy per type
+    # - pair_acc[thread, type, type, bin]  pair distance histogram up to R_max
+    #
+    # 'pair_radii' is only read by the kernels generated for pair radii force laws
+
     checks = 0
+    max_disp = 0.0
 
     half_map = map_size / 2.0
     max_dist_sq = R_max * R_max + 1.0
+    num_bins = pair_acc.shape[3]
 
     for i in prange(N):
         f_x, f_y = 0.0, 0.0
         pos_x, pos_y = positions[i]
         p_type = types[i]
+        thread = get_thread_id()
 
-        # Determine current cell coordinates
-        cell_x = int32(pos_x / cell_size)
-        cell_y = int32(pos_y / cell_size)
+        # Determine current cell coordinates, clamped because 'x % map_size'
+        # can round up to map_size for tiny negative x
+        cell_x = min(int32(pos_x / cell_size), grid_dim - 1)
+        cell_y = min(int32(pos_y / cell_size), grid_dim - 1)
         
         # Search the 3x3 neighborhood of cells
         for dx in range(-1, 2):
@@ -79,42 +99,310 @@ def update_particles(
                         continue
 
                     dist = np.sqrt(dist_sq)
-                    interaction = matrix[types[i2], p_type]
+                    o_type = types[i2]
+                    interaction = matrix[o_type, p_type]
+
+                    # We already have the distance so the histogram is almost free
+                    if analytics and dist < R_max:
+                        pair_acc[thread, p_type, o_type, int32(dist / R_max * num_bins)] += 1
+
                     force = calculate_force(dist, R_min, R_max, interaction)
 
                     # Accumulate normalized force vectors
                     f_x += force * (dx_val / dist)
                     f_y += force * (dy_val / dist)
 
-      
-        vx = (velocities[i, 0] + f_x * dt) * friction
-        vy = (velocities[i, 1] + f_y * dt) * friction
 
-        # Limit speeed 
-       
-        speed_sq = vx**2 + vy**2
-        if speed_sq > max_speed**2:
-            scale = max_speed / np.sqrt(speed_sq)
-            vx *= scale
-            vy *= scale
+        vx, vy = integrate_particle(
+            positions, velocities, i, pos_x, pos_y, f_x, f_y, friction, dt, max_speed, map_size
+        )
 
-        velocities[i, 0], velocities[i, 1] = vx, vy
+        if analytics:
+            energy_acc[thread, p_type] += 0.5 * (vx**2 + vy**2)
 
-        # Update position with tordial wrapping
-        positions[i, 0] = (pos_x + vx * dt) % map_size
-        positions[i, 1] = (pos_y + vy * dt) % map_size
-    return checks
+        # Keep track of the largest displacement for the adaptive timestep
+        max_disp = max(max_disp, np.sqrt(vx**2 + vy**2) * dt)
+    return checks, max_disp
 
 
-@njit(cache=True)
+@njit(parallel=True, cache=True, nogil=True)
+def update_particles_far_field(
+    positions, velocities, types, N, R_min, R_max, matrix, 
+    friction, dt, max_speed, map_size, grid_pos, grid_counts, cell_size, grid_dim,
+    analytics, energy_acc, pair_acc, pair_radii, cell_mass, cell_com, reach, theta
+):
+    # Same step as update_particles but for a grid finer than R_max. We search
+    # 'reach' cells in every direction and cells that are far away compared to their
+    # size (Barnes-Hut like: cell_size < theta * distance) are replaced by a single
+    # interaction per type with the per-type mass and center of mass of that cell.
+    # Cells which could hold particles within R_min are always evaluated exactly
+
+    checks = 0
+    max_disp = 0.0
+
+    half_map = map_size / 2.0
+    max_dist_sq = R_max * R_max + 1.0
+    num_bins = pair_acc.shape[3]
+    num_types = cell_mass.shape[1]
+
+    # Half the cell diagonal, used to check if a whole cell is in or out of range
+    half_diag = cell_size * np.sqrt(0.5)
+
+    for i in prange(N):
+        f_x, f_y = 0.0, 0.0
+        pos_x, pos_y = positions[i]
+        p_type = types[i]
+        thread = get_thread_id()
+
+        # Determine current cell coordinates, clamped because 'x % map_size'
+        # can round up to map_size for tiny negative x
+        cell_x = min(int32(pos_x / cell_size), grid_dim - 1)
+        cell_y = min(int32(pos_y / cell_size), grid_dim - 1)
+        
+        # Search the (2 * reach + 1)^2 neighborhood of cells
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                # Wrapped grid coordinates
+                nx = (cell_x + dx) % grid_dim
+                ny = (cell_y + dy) % grid_dim
+                
+                cell_id = ny * grid_dim + nx
+                if grid_counts[cell_id] == 0:
+                    continue
+
+                # Distance to the cell center
+                cx_val = (nx + 0.5) * cell_size - pos_x
+                cy_val = (ny + 0.5) * cell_size - pos_y
+
+                if cx_val > half_map:     cx_val -= map_size 
+                elif cx_val < -half_map:  cx_val += map_size 
+                if cy_val > half_map:     cy_val -= map_size 
+                elif cy_val < -half_map:  cy_val += map_size 
+
+                cell_dist = np.sqrt(cx_val**2 + cy_val**2)
+
+                # The whole cell is out of range
+                if cell_dist - half_diag > R_max:
+                    continue
+
+                # Far field: one interaction per type using the cell aggregates
+                if cell_dist - half_diag > R_min and cell_size < theta * cell_dist:
+                    for o_type in range(num_types):
+                        mass = cell_mass[cell_id, o_type]
+                        if mass == 0.0:
+                            continue
+                        checks += 1
+
+                        dx_val = cell_com[cell_id, o_type, 0] - pos_x
+                        dy_val = cell_com[cell_id, o_type, 1] - pos_y
+
+                        if dx_val > half_map:     dx_val -= map_size 
+                        elif dx_val < -half_map:  dx_val += map_size 
+                        if dy_val > half_map:     dy_val -= map_size 
+                        elif dy_val < -half_map:  dy_val += map_size 
+
+                        dist_sq = dx_val**2 + dy_val**2
+                        if dist_sq > max_dist_sq or dist_sq < 1e-9:
+                            continue
+
+                        dist = np.sqrt(dist_sq)
+
+                        if analytics and dist < R_max:
+                            pair_acc[thread, p_type, o_type, int32(dist / R_max * num_bins)] += int32(mass)
+
+                        force = calculate_force(dist, R_min, R_max, matrix[o_type, p_type]) * mass
+                        f_x += force * (dx_val / dist)
+                        f_y += force * (dy_val / dist)
+                    continue
+
+                # Near field: check particles within the cell
+                start_idx = grid_pos[cell_id]
+                end_idx = start_idx + grid_counts[cell_id]
+
+                for i2 in range(start_idx, end_idx):
+                    checks += 1
+                    if i == i2: 
+                        continue
+
+                    #  Relative vector
+                    dx_val = positions[i2, 0] - pos_x
+                    dy_val = positions[i2, 1] - pos_y
+
+                    # Toroidal distance correction
+                    if dx_val > half_map:     dx_val -= map_size 
+                    elif dx_val < -half_map:  dx_val += map_size 
+                    if dy_val > half_map:     dy_val -= map_size 
+                    elif dy_val < -half_map:  dy_val += map_size 
+
+                    dist_sq = dx_val**2 + dy_val**2
+                    
+                    if dist_sq > max_dist_sq or dist_sq < 1e-9:
+                        continue
+
+                    dist = np.sqrt(dist_sq)
+                    o_type = types[i2]
+                    interaction = matrix[o_type, p_type]
+
+                    if analytics and dist < R_max:
+                        pair_acc[thread, p_type, o_type, int32(dist / R_max * num_bins)] += 1
+
+                    force = calculate_force(dist, R_min, R_max, interaction)
+
+                    # Accumulate normalized force vectors
+                    f_x += force * (dx_val / dist)
+                    f_y += force * (dy_val / dist)
+
+        vx, vy = integrate_particle(
+            positions, velocities, i, pos_x, pos_y, f_x, f_y, friction, dt, max_speed, map_size
+        )
+
+        if analytics:
+            energy_acc[thread, p_type] += 0.5 * (vx**2 + vy**2)
+
+        max_disp = max(max_disp, np.sqrt(vx**2 + vy**2) * dt)
+    return checks, max_disp
+
+
+@njit(cache=True, nogil=True)
+def aggregate_cells(positions, types, N, grid_indices, cell_mass, cell_com):
+    # Computes the number of particles (mass) and the center of mass of every
+    # type in every cell. Cells never wrap so a plain average works
+    cell_mass[:, :] = 0.0
+    cell_com[:, :, :] = 0.0
+
+    for i in range(N):
+        cell_id = grid_indices[i]
+        p_type = types[i]
+        cell_mass[cell_id, p_type] += 1.0
+        cell_com[cell_id, p_type, 0] += positions[i, 0]
+        cell_com[cell_id, p_type, 1] += positions[i, 1]
+
+    for cell_id in range(cell_mass.shape[0]):
+        for t in range(cell_mass.shape[1]):
+            if cell_mass[cell_id, t] > 0.0:
+                cell_com[cell_id, t, 0] /= cell_mass[cell_id, t]
+                cell_com[cell_id, t, 1] /= cell_mass[cell_id, t]
+
+
+@njit(cache=True, nogil=True)
 def map_particles_to_cells(pos, N, cell_size, grid_dim, grid_indices):
     # Maps all particle indices to their corresponding  grid index
+    # (clamped, see update_particles)
     for i in range(N):
-        cx = int32(pos[i, 0] / cell_size)
-        cy = int32(pos[i, 1] / cell_size)
+        cx = min(int32(pos[i, 0] / cell_size), grid_dim - 1)
+        cy = min(int32(pos[i, 1] / cell_size), grid_dim - 1)
         grid_indices[i] = cy * grid_dim + cx
 
 
+# ---------------------------------------------------------------------------------
+# Force law specialization
+
+# Kernels per force law, compiled (or loaded from the Numba cache) once per process
+compiled_kernels = {}
+
+# Places for the generated kernel modules, in order of preference. The source tree
+# can be read-only (for example an installed copy) so we fall back to the
+# NUMBA_CACHE_DIR (when set) and the user cache directory
+KERNEL_DIRS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "force_laws"),
+    os.path.join(config.CACHE_DIR, "force_laws") if config.CACHE_DIR else None,
+    os.path.join(user_cache_dir("particle_life"), "force_laws"),
+]
+
+def kernel_dir():
+    # Returns the first kernel directory we can write to
+    for directory in KERNEL_DIRS:
+        if directory is None:
+            continue
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(directory, os.W_OK):
+            return directory
+
+    raise PermissionError(
+        "No writable directory for the generated force law kernels, tried: "
+        + ", ".join(d for d in KERNEL_DIRS if d) + ". Set NUMBA_CACHE_DIR to a writable directory"
+    )
+
+def source_hash(function):
+    # Hash of the source of a (Numba) function, "unknown" when there is no source
+    py_func = getattr(function, 'py_func', function)
+    try:
+        return hashlib.sha1(inspect.getsource(py_func).encode()).hexdigest()
+    except (OSError, TypeError):
+        return "unknown"
+
+def compile_force_law(name):
+    # Returns the (update_particles, update_particles_far_field) kernels for a registered
+    # force law. For every law (the default one too) we write a copy of the kernels to
+    # a small module where 'calculate_force' is replaced by the law, so the law is
+    # inlined in the inner loop. Numba caches these modules on disk like any other
+    # (the modules are written to the first writable place in KERNEL_DIRS).
+    # update_particles and update_particles_far_field in this file are only the templates
+    if name in compiled_kernels:
+        return compiled_kernels[name]
+
+    law = FORCE_LAWS[name]
+    py_func = getattr(law.function, 'py_func', law.function)
+    module, qualname = py_func.__module__, py_func.__qualname__
+    if '<' in qualname:
+        raise ValueError(f"Force law '{name}' has to be a module level function")
+
+    # Pair radii laws read R_min and R_max from the per type pair table
+    if law.pair_radii:
+        call = "force_law(dist, pair_radii[o_type, p_type, 0], pair_radii[o_type, p_type, 1], "
+    else:
+        call = "force_law(dist, R_min, R_max, "
+
+    kernels = ""
+    for kernel in (update_particles, update_particles_far_field):
+        kernels += "\n\n" + inspect.getsource(kernel.py_func).replace("calculate_force(dist, R_min, R_max, ", call)
+
+    # Numba only checks the file of the cached function, not the files of the functions
+    # it inlines. The hashes make sure the module (and so the Numba cache) changes
+    # whenever the law, integrate_particle or the template kernels change
+    source = (
+        f"# Generated by particleManager.compile_force_law for the '{name}' force law\n"
+        f"# Law: {module}.{qualname} ({source_hash(py_func)})\n"
+        f"# integrate_particle: {source_hash(integrate_particle)}\n"
+        f"# update_particles: {source_hash(update_particles)}\n"
+        f"# update_particles_far_field: {source_hash(update_particles_far_field)}\n"
+        "import numpy as np\n"
+        "from numba import njit, int32, float64, prange, get_thread_id\n"
+        "from particleManager import integrate_particle\n"
+        f"from {module} import {qualname} as force_law\n"
+        "\n"
+        "# Plain Python laws get compiled here\n"
+        "if not hasattr(force_law, 'py_func'):\n"
+        "    force_law = njit(cache=True)(force_law)\n"
+        + kernels
+    )
+
+    # Only write when something changed, otherwise Numba's cache would be invalidated
+    safe_name = "".join(c if c.isalnum() else "_" for c in name)
+    path = os.path.join(kernel_dir(), f"kernels_{safe_name}.py")
+
+    existing = None
+    if os.path.exists(path):
+        with open(path) as file:
+            existing = file.read()
+    if existing != source:
+        with open(path, "w") as file:
+            file.write(source)
+
+    spec = importlib.util.spec_from_file_location(f"force_law_kernels_{safe_name}", path)
+    generated = importlib.util.module_from_spec(spec)
+
+    # Numba needs to find the module by name when loading from the cache
+    sys.modules[spec.name] = generated
+    spec.loader.exec_module(generated)
+
+    compiled_kernels[name] = (generated.update_particles, generated.update_particles_far_field)
+    return compiled_kernels[name]
+
+
 class ParticleManager:
     def __init__(self, **kwargs):
         # Configure all variables
@@ -126,58 +414,354 @@ class ParticleManager:
         self.friction       = kwargs.get('friction')
         self.dt             = kwargs.get('dt')
         self.max_speed      = kwargs.get('max_speed')
-        self.matrix         = kwargs.get('interaction_matrix').astype(np.float64)
+
+        # Threads used by the physics kernels (None or 0 is all of them)
+        self.physics_threads = kwargs.get('physics_threads')
+
+        # Adaptive substepping, a frame of 'dt' is split into substeps so no
+        # particle moves more than 'max_cell_fraction' of a cell per substep
+        self.adaptive          = kwargs.get('adaptive', False)
+        self.max_cell_fraction = kwargs.get('max_cell_fraction', 0.5)
+        self.max_substeps      = kwargs.get('max_substeps', 8)
+        self.substeps          = 1
+        self.max_displacement  = 0.0
+
+        # Capacities, the state arrays are allocated once at these sizes and
+        # only the first 'particle_count' entries are active. This way we can
+        # spawn/despawn particles and swap the types without reallocating
+        self.capacity  = max(kwargs.get('capacity') or self.particle_count, self.particle_count)
+        self.max_types = max(kwargs.get('max_types') or self.num_types, self.num_types)
+
+        # The matrix always has the full 'max_types' shape so Numba never
+        # sees a new array layout, unused rows and columns stay zero
+        self.matrix = np.zeros((self.max_types, self.max_types), dtype=np.float64)
+        self.matrix[:self.num_types, :self.num_types] = kwargs.get('interaction_matrix')
+
+        # Far-field approximation, the grid is made 'far_field_subdivisions' times
+        # finer than R_max so distant cells can be approximated by their aggregates.
+        # A smaller 'far_field_theta' is more accurate (0 means everything exact)
+        self.far_field              = kwargs.get('far_field', False)
+        self.far_field_subdivisions = kwargs.get('far_field_subdivisions', 4)
+        self.far_field_theta        = kwargs.get('far_field_theta', 0.5)
 
         # Spatial grid
         self.cell_size = kwargs.get('cell_size')
         self.GRID_DIM  = self.map_size // self.cell_size + 1
+
+        if self.far_field:
+            # Cells have to tile the map exactly, otherwise the wrapped neighbours
+            # at the map edge are not at the distance the stencil expects
+            self.GRID_DIM  = int(np.ceil(self.map_size * self.far_field_subdivisions / self.cell_size))
+            self.cell_size = self.map_size / self.GRID_DIM
+            self.reach     = min(int(np.ceil(self.R_max / self.cell_size)), (self.GRID_DIM - 1) // 2)
+
         self.GRID_SIZE = self.GRID_DIM ** 2
         
         # Particle state arrays
-        self.pos   = np.random.uniform(0, self.map_size, (self.particle_count, 2)).astype(np.float64)
-        self.vel   = np.zeros((self.particle_count, 2), dtype=np.float64)
-        self.types = np.random.randint(0, self.num_types, self.particle_count, dtype=np.int32)
+        self.pos   = np.zeros((self.capacity, 2), dtype=np.float64)
+        self.vel   = np.zeros((self.capacity, 2), dtype=np.float64)
+        self.types = np.zeros(self.capacity, dtype=np.int32)
+
+        # Stable particle ids, these follow the particles through the grid sorting
+        # so a frame can be compared to the previous one (used for streaming)
+        self.ids     = np.zeros(self.capacity, dtype=np.int64)
+        self.next_id = 0
         
         # Spatial grid buffers
-        self.grid_indices = np.zeros(self.particle_count, dtype=np.int32)
+        self.grid_indices = np.zeros(self.capacity, dtype=np.int32)
         self.grid_counts  = np.zeros(self.GRID_SIZE, dtype=np.int32) 
         self.grid_pos     = np.zeros(self.GRID_SIZE, dtype=np.int32)  
 
+        # Per cell and per type aggregates for the far-field mode
+        if self.far_field:
+            self.cell_mass = np.zeros((self.GRID_SIZE, self.max_types), dtype=np.float64)
+            self.cell_com  = np.zeros((self.GRID_SIZE, self.max_types, 2), dtype=np.float64)
+
+        # Analytics, computed inside the physics kernel when enabled. The accumulators
+        # have a row per thread and are always allocated (tiny when disabled) so the
+        # kernel is compiled only once
+        self.analytics = kwargs.get('analytics', False)
+        self.rdf_bins  = kwargs.get('rdf_bins', 32)
+
+        acc_types = self.max_types if self.analytics else 1
+        acc_bins  = self.rdf_bins if self.analytics else 1
+        self.energy_acc = np.zeros((config.NUMBA_NUM_THREADS, acc_types), dtype=np.float64)
+        self.pair_acc   = np.zeros((config.NUMBA_NUM_THREADS, acc_types, acc_types, acc_bins), dtype=np.int64)
+
+        # Merged results of the last step
+        self.kinetic_energy      = np.zeros(acc_types, dtype=np.float64)
+        self.pair_histogram      = np.zeros((acc_types, acc_types, acc_bins), dtype=np.float64)
+        self.occupancy_histogram = np.zeros(1, dtype=np.int64)
+
+        # Force law and the per type pair radii (R_min, R_max) used by pair radii laws,
+        # by default every pair uses the global radii
+        self.pair_radii = np.zeros((self.max_types, self.max_types, 2), dtype=np.float64)
+        self.pair_radii[:, :, 0] = self.R_min
+        self.pair_radii[:, :, 1] = self.R_max
+        if kwargs.get('pair_radii') is not None:
+            self.set_pair_radii(kwargs.get('pair_radii'))
+
+        self.set_force_law(kwargs.get('force_law', 'sine'))
+
+        self.randomize_particles()
+
+    # --------------------------------------------------------------------------------------
+    # In place state changes, these should be called between two update() calls
+
+    def randomize_particles(self):
+        # Scatter the active particles over the map with random types
+        n = self.particle_count
+        self.pos[:n]   = np.random.uniform(0, self.map_size, (n, 2))
+        self.vel[:n]   = 0.0
+        self.types[:n] = np.random.randint(0, self.num_types, n, dtype=np.int32)
+        self.ids[:n]   = np.arange(n)
+        self.next_id   = n
+
+    def reset(self, interaction_matrix, particle_count=None):
+        # Restart the simulation with a new matrix (and so maybe a new number of
+        # types) while keeping all the allocated buffers
+        if particle_count is not None:
+            self.particle_count = min(particle_count, self.capacity)
+
+        # No remap of the types here, randomize_particles overwrites them anyway and
+        # an extra random draw would shift the seeded sequence
+        self.set_interaction_matrix(interaction_matrix, remap_types=False)
+        self.randomize_particles()
+
+        # The substepping of the previous run shouldn't carry over
+        self.substeps = 1
+        self.max_displacement = 0.0
+
+    def set_interaction_matrix(self, interaction_matrix, remap_types=True):
+        # Hot-swap the interaction matrix. Its shape decides the number of types,
+        # with 'remap_types' particles with a type that no longer exists get a new random one
+        num_types = interaction_matrix.shape[0]
+        if num_types > self.max_types:
+            raise ValueError(f"Matrix has {num_types} types but max_types is {self.max_types}")
+
+        self.matrix[:, :] = 0.0
+        self.matrix[:num_types, :num_types] = interaction_matrix
+
+        if remap_types and num_types < self.num_types:
+            n = self.particle_count
+            removed = self.types[:n] >= num_types
+            self.types[:n][removed] = np.random.randint(0, num_types, np.count_nonzero(removed), dtype=np.int32)
+
+        self.num_types = num_types
+
+    def set_force_law(self, name):
+        # Switch to another registered force law, the kernels are compiled or
+        # loaded from the cache the first time a law is used
+        self.kernel, self.far_field_kernel = compile_force_law(name)
+        self.force_law = name
+
+    def set_pair_radii(self, pair_radii):
+        # Set R_min and R_max per type pair (shape [types, types, 2]). R_max can't be
+        # larger than the global R_max because that decides the grid
+        num_types = pair_radii.shape[0]
+        self.pair_radii[:num_types, :num_types] = np.clip(pair_radii, 1e-6, self.R_max)
+
+    def spawn(self, positions, types, velocities=None):
+        # Append new particles to the end of the active range. Particles that
+        # don't fit in the capacity are dropped, returns how many were added
+        types = np.asarray(types)
+        if len(types) and (types.min() < 0 or types.max() >= self.num_types):
+            raise ValueError(f"Particle types have to be in [0, {self.num_types})")
+
+        start = self.particle_count
+        count = min(len(positions), self.capacity - start)
+        end = start + count
+
+        self.pos[start:end]   = np.asarray(positions[:count]) % self.map_size
+        self.types[start:end] = types[:count]
+        if velocities is None:
+            self.vel[start:end] = 0.0
+        else:
+            self.vel[start:end] = velocities[:count]
+
+        self.ids[start:end] = np.arange(self.next_id, self.next_id + count)
+        self.next_id += count
+
+        self.particle_count = end
+        return count
+
+    def despawn(self, indices):
+        # Remove the particles at the given (active) indices by compacting the
+        # remaining particles to the front, returns how many were removed
+        n = self.particle_count
+        keep = np.ones(n, dtype=np.bool_)
+        keep[indices] = False
+        remaining = np.count_nonzero(keep)
+
+        self.pos[:remaining]   = self.pos[:n][keep]
+        self.vel[:remaining]   = self.vel[:n][keep]
+        self.types[:remaining] = self.types[:n][keep]
+        self.ids[:remaining]   = self.ids[:n][keep]
+
+        self.particle_count = remaining
+        return n - remaining
+
+    # --------------------------------------------------------------------------------------
+    # Simulation step
+
     def update_grid(self):
         # Reorders particles by grid cell
-        map_particles_to_cells(self.pos, self.particle_count, self.cell_size, self.GRID_DIM, self.grid_indices)
+        n = self.particle_count
+        map_particles_to_cells(self.pos, n, self.cell_size, self.GRID_DIM, self.grid_indices)
         
         # Sort indices to group particles by cell
-        sorted_indices = np.argsort(self.grid_indices)
-        
-        # Reorder all simulation arrays
-        self.pos = self.pos[sorted_indices]
-        self.vel = self.vel[sorted_indices]
-        self.types = self.types[sorted_indices]
-        self.grid_indices = self.grid_indices[sorted_indices]
-        
-       
-        self.grid_counts[:] = 0
-        self.grid_pos[:] = 0
+        sorted_indices = np.argsort(self.grid_indices[:n])
         
-        unique_cells, counts = np.unique(self.grid_indices, return_counts=True)
-        self.grid_counts[unique_cells] = counts
+        # Reorder all simulation arrays, we write back into the existing
+        # buffers so the arrays passed to Numba stay the same
+        self.pos[:n] = self.pos[sorted_indices]
+        self.vel[:n] = self.vel[sorted_indices]
+        self.types[:n] = self.types[sorted_indices]
+        self.ids[:n] = self.ids[sorted_indices]
+        self.grid_indices[:n] = self.grid_indices[sorted_indices]
         
-        # Calculate offsets for each cell
-        self.grid_pos[1:] = np.cumsum(self.grid_counts)[:-1]
+        # Count the particles per cell and calculate offsets for each cell
+        self.grid_counts[:] = np.bincount(self.grid_indices[:n], minlength=self.GRID_SIZE)
+        self.grid_pos[0] = 0
+        np.cumsum(self.grid_counts[:-1], out=self.grid_pos[1:])
+
+    def merge_analytics(self, substeps):
+        # Sum the per-thread accumulators of the last frame and average them over its
+        # substeps. The occupancy histogram (how many cells hold k particles) only
+        # needs the grid counts we already have, so it is from the last substep
+        self.kinetic_energy[:]      = self.energy_acc.sum(axis=0) / substeps
+        self.pair_histogram[:]      = self.pair_acc.sum(axis=0) / substeps
+        self.occupancy_histogram    = np.bincount(self.grid_counts)
+
+    def radial_distribution(self):
+        # Normalize the pair histogram to the radial distribution function g(r)
+        # for every type pair, g = 1 means the pair is spread uniformly
+        n = self.particle_count
+        type_counts = np.bincount(self.types[:n], minlength=self.pair_histogram.shape[0])
+
+        edges = np.linspace(0.0, self.R_max, self.rdf_bins + 1)
+        shell_area = np.pi * (edges[1:] ** 2 - edges[:-1] ** 2)
+        density = type_counts / self.map_size ** 2
+
+        expected = type_counts[:, None, None] * density[None, :, None] * shell_area[None, None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rdf = np.where(expected > 0, self.pair_histogram / expected, 0.0)
+
+        return edges, rdf
+
+    def choose_substeps(self, displacement):
+        # The number of substeps needed to keep a displacement (over the whole
+        # 'dt') below 'max_cell_fraction' of a cell. With the far-field grid that is
+        # the 'reach' cells the stencil spans (about R_max), not one of the fine cells
+        if not self.adaptive:
+            return 1
+
+        stencil_cell = self.reach * self.cell_size if self.far_field else self.cell_size
+        max_step = self.max_cell_fraction * stencil_cell
+        substeps = int(np.ceil(displacement / max_step))
+        return min(max(substeps, 1), self.max_substeps)
 
     def update(self):
-        # Update the whole simulation for one frame
+        # Update the whole simulation for one frame. The substeps are first picked
+        # from the previous frame, velocities change little between frames
+        substeps = self.choose_substeps(self.max_displacement)
 
-        # Initialize the grid
-        self.update_grid()
-        
-        # Compute the physics
-        checks = update_particles(
-            self.pos, self.vel, self.types, self.particle_count, 
-            self.R_min, self.R_max, self.matrix, self.friction, self.dt, self.max_speed, self.map_size,
-            self.grid_pos, self.grid_counts, self.cell_size, self.GRID_DIM
-        )
+        # With per pair radii R_min is only used to keep the near field exact
+        r_min = self.R_min
+        if FORCE_LAWS[self.force_law].pair_radii:
+            r_min = self.pair_radii[:, :, 0].max()
+
+        # The analytics accumulate over all substeps of the frame
+        if self.analytics:
+            self.energy_acc[:] = 0.0
+            self.pair_acc[:] = 0
+
+        checks = 0
+        max_disp = 0.0
+        done = 0
+        remaining = self.dt
+        while done < substeps:
+            sub_dt = remaining / (substeps - done)
+
+            # Friction is applied once per step, so we scale it to keep the
+            # damping per frame the same no matter the number of substeps
+            sub_friction = self.friction ** (sub_dt / self.dt)
+
+            # Initialize the grid
+            self.update_grid()
+            step_checks, step_disp = self.step(r_min, sub_friction, sub_dt)
+            checks += step_checks
+            done += 1
+            remaining -= sub_dt
+
+            # Store the displacement as if the whole frame was a single step
+            frame_disp = step_disp * self.dt / sub_dt
+            max_disp = max(max_disp, frame_disp)
+
+            # When the velocities spiked during this frame, the rest of the
+            # frame is split into more substeps (this substep already moved)
+            if done < substeps:
+                needed = done + self.choose_substeps(frame_disp * remaining / self.dt)
+                substeps = max(substeps, min(needed, self.max_substeps))
+
+        self.substeps = done
+        self.max_displacement = max_disp
+
+        if self.analytics:
+            self.merge_analytics(done)
        
+        n = self.particle_count
+        return self.pos[:n], self.types[:n], checks
+
+    def step(self, r_min, friction, dt):
+        # Runs the physics kernel once with the physics thread count
+        with use_threads(self.physics_threads):
+            if self.far_field:
+                aggregate_cells(
+                    self.pos, self.types, self.particle_count, self.grid_indices,
+                    self.cell_mass, self.cell_com
+                )
+                return self.far_field_kernel(
+                    self.pos, self.vel, self.types, self.particle_count, 
+                    r_min, self.R_max, self.matrix, friction, dt, self.max_speed, self.map_size,
+                    self.grid_pos, self.grid_counts, self.cell_size, self.GRID_DIM,
+                    self.analytics, self.energy_acc, self.pair_acc, self.pair_radii,
+                    self.cell_mass, self.cell_com, self.reach, self.far_field_theta
+                )
+
+            return self.kernel(
+                self.pos, self.vel, self.types, self.particle_count, 
+                r_min, self.R_max, self.matrix, friction, dt, self.max_speed, self.map_size,
+                self.grid_pos, self.grid_counts, self.cell_size, self.GRID_DIM,
+                self.analytics, self.energy_acc, self.pair_acc, self.pair_radii
+            )
+
 
-        return self.pos, self.types, checks
\ No newline at end of file
+def manager_from_config(cfg, interaction_matrix, **overrides):
+    # Builds a ParticleManager from the configuration dictionary of main.py,
+    # 'overrides' replace single configuration entries
+    cfg = {**cfg, **overrides}
+    return ParticleManager(
+        particle_count=cfg.get('particle_count'),
+        capacity=cfg.get('particle_capacity'),
+        map_size=cfg.get('map_size'),
+        num_types=interaction_matrix.shape[0],
+        max_types=cfg.get('max_types'),
+        min_r=cfg.get('min_r'),
+        max_r=cfg.get('max_r'),
+        cell_size=cfg.get('cell_size'),
+        interaction_matrix=interaction_matrix,
+        friction=cfg.get('friction'),
+        dt=cfg.get('delta_time'),
+        max_speed=cfg.get('max_speed'),
+        physics_threads=cfg.get('physics_threads'),
+        adaptive=cfg.get('adaptive', False),
+        max_cell_fraction=cfg.get('max_cell_fraction', 0.5),
+        max_substeps=cfg.get('max_substeps', 8),
+        analytics=cfg.get('analytics', False),
+        rdf_bins=cfg.get('rdf_bins', 32),
+        far_field=cfg.get('far_field', False),
+        far_field_subdivisions=cfg.get('far_field_subdivisions', 4),
+        far_field_theta=cfg.get('far_field_theta', 0.5),
+        force_law=cfg.get('force_law', 'sine')
+    )
@@ -0,0 +1,68 @@
+import time
+import numpy as np
+import numba
+from particleManager import manager_from_config
+from threadControl import clamp_threads
+
+# ---------------------------------------------------------------------------------
+# Scaling report
+
+def time_engine(cfg, threads, particle_count, map_size, steps, warmup):
+    # Returns the average seconds per update() for a fresh engine with these settings
+    np.random.seed(cfg.get('initial_seed', 0))
+    num_types = cfg.get('initial_num_types')
+    interaction_matrix = np.random.uniform(-1.0, 1.0, (num_types, num_types)) * 1.5
+
+    # Adaptive substepping and analytics change the work per update() with the
+    # dynamics, which differ between runs, so they are off for a fair comparison
+    manager = manager_from_config(
+        cfg, interaction_matrix,
+        particle_count=particle_count, particle_capacity=particle_count,
+        map_size=map_size, physics_threads=threads,
+        adaptive=False, analytics=False
+    )
+
+    for _ in range(warmup):
+        manager.update()
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        manager.update()
+    return (time.perf_counter() - start) / steps
+
+
+def scaling_report(cfg, max_threads=None, steps=50, warmup=5):
+    # Runs the physics at 1..max_threads threads and prints the speedup and efficiency for
+    # - strong scaling: the same problem on more threads (ideal speedup = threads)
+    # - weak scaling:   particles and map area grow with the threads (ideal time stays the same)
+    max_threads = clamp_threads(max_threads)
+    base_count = cfg.get('particle_count')
+    base_map = cfg.get('map_size')
+
+    rows = []
+    for threads in range(1, max_threads + 1):
+        strong = time_engine(cfg, threads, base_count, base_map, steps, warmup)
+
+        # Keep the density the same
+        weak_map = int(round(base_map * np.sqrt(threads)))
+        weak = time_engine(cfg, threads, base_count * threads, weak_map, steps, warmup)
+
+        rows.append({"threads": threads, "strong_time": strong, "weak_time": weak})
+
+    strong_base = rows[0]["strong_time"]
+    weak_base = rows[0]["weak_time"]
+
+    print(f"Scaling report ({numba.threading_layer()} threading layer, {steps} steps)")
+    print(f"{'threads':>8} | {'strong ms':>10} {'speedup':>8} {'eff':>6} | {'weak ms':>10} {'eff':>6}")
+    for row in rows:
+        threads = row["threads"]
+        row["strong_speedup"] = strong_base / row["strong_time"]
+        row["strong_efficiency"] = row["strong_speedup"] / threads
+        row["weak_efficiency"] = weak_base / row["weak_time"]
+
+        print(
+            f"{threads:>8} | {row['strong_time'] * 1000:>10.2f} {row['strong_speedup']:>8.2f} "
+            f"{row['strong_efficiency']:>6.0%} | {row['weak_time'] * 1000:>10.2f} {row['weak_efficiency']:>6.0%}"
+        )
+
+    return rows
@@ -0,0 +1,300 @@
+import asyncio
+import random
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+from particleManager import manager_from_config
+
+# ---------------------------------------------------------------------------------
+# Wire format
+#
+# Every message is a 4 byte little endian length followed by a zlib compressed body.
+# The body starts with a header (kind, frame number, particle count, map size):
+# - KEY_FRAME:   uint16 quantized x,y for every particle + uint8 types
+# - DELTA_FRAME: uint16 difference (mod 2^16) to the previous frame sent to this
+#                viewer, particles are in the same (id) order so no types are sent
+#
+# Positions are quantized to 16 bits over the map, for a 300 map that is ~0.005 units
+#
+# After every frame the viewer sends a single ACK byte. The server only sends the next
+# frame after that, so a slow viewer gets the newest frame and skips the ones between
+
+KEY_FRAME   = 0
+DELTA_FRAME = 1
+
+HEADER = struct.Struct('<BIIf')
+LENGTH = struct.Struct('<I')
+ACK    = b'\x01'
+
+QUANTIZE_LEVELS = 65536
+
+
+def quantize_positions(positions, map_size):
+    # Maps the positions in [0, map_size) to uint16
+    q = positions * (QUANTIZE_LEVELS / map_size)
+    return np.clip(q, 0, QUANTIZE_LEVELS - 1).astype(np.uint16)
+
+
+def encode_frame(frame_number, quantized, types, map_size, previous=None):
+    # Encodes a frame, as delta against 'previous' (the last quantized positions
+    # sent to the viewer) when given, otherwise as key frame
+    count = len(quantized)
+
+    if previous is None:
+        header = HEADER.pack(KEY_FRAME, frame_number, count, map_size)
+        body = header + quantized.tobytes() + types.astype(np.uint8).tobytes()
+    else:
+        # uint16 arithmetic wraps around which is exactly what we want
+        # for particles crossing the map edge
+        delta = quantized - previous
+        header = HEADER.pack(DELTA_FRAME, frame_number, count, map_size)
+        body = header + delta.tobytes()
+
+    payload = zlib.compress(body, 1)
+    return LENGTH.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    # Client side counterpart of encode_frame, keeps the state needed for delta frames
+    def __init__(self):
+        self.quantized = None
+        self.types = None
+        self.frame_number = -1
+        self.map_size = None
+
+    def decode(self, payload):
+        # Decodes one message body (without the length prefix) and
+        # returns the positions (float) and types
+        body = zlib.decompress(payload)
+        kind, frame_number, count, map_size = HEADER.unpack_from(body)
+        data = memoryview(body)[HEADER.size:]
+
+        if kind == KEY_FRAME:
+            self.quantized = np.frombuffer(data[:count * 4], dtype=np.uint16).reshape(count, 2).copy()
+            self.types = np.frombuffer(data[count * 4:], dtype=np.uint8).astype(np.int32)
+        else:
+            delta = np.frombuffer(data, dtype=np.uint16).reshape(count, 2)
+            self.quantized += delta
+
+        self.frame_number = frame_number
+        self.map_size = map_size
+        positions = self.quantized.astype(np.float64) * (map_size / QUANTIZE_LEVELS)
+        return positions, self.types
+
+
+async def read_frame(reader):
+    # Reads one length prefixed message from a stream
+    length_data = await reader.readexactly(LENGTH.size)
+    (length,) = LENGTH.unpack(length_data)
+    return await reader.readexactly(length)
+
+
+# ---------------------------------------------------------------------------------
+# Server
+
+class Snapshot:
+    # A copy of the simulation state. The copy is taken on the physics thread, the
+    # id sort and quantization happen on the asyncio side in prepare()
+    def __init__(self, frame_number, ids, positions, types):
+        self.frame_number = frame_number
+        self.ids = ids
+        self.positions = positions
+        self.types = types
+        self.quantized = None
+
+    def prepare(self, map_size):
+        # Puts the particles in id order so frames can be compared and quantizes the
+        # positions. Only done once per snapshot and only for snapshots that get sent
+        if self.quantized is not None:
+            return
+
+        order = np.argsort(self.ids)
+        self.ids = self.ids[order]
+        self.types = self.types[order]
+        self.quantized = quantize_positions(self.positions[order], map_size)
+        self.positions = None
+
+
+class Viewer:
+    # The per connection state, 'pending' only ever holds the newest snapshot so
+    # a slow viewer skips frames (counted in 'frames_dropped') instead of building up a queue
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = None
+        self.new_frame = asyncio.Event()
+        self.last_sent = None
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+
+class StreamServer:
+    def __init__(self, **kwargs):
+        # Configure the server, the remaining settings are the same as for the Simulation
+        self.host              = kwargs.get('server_host', '127.0.0.1')
+        self.port              = kwargs.get('server_port', 5555)
+        self.max_fps           = kwargs.get('server_max_fps', 60)
+        self.keyframe_interval = kwargs.get('keyframe_interval', 120)
+        self.map_size          = kwargs.get('map_size')
+
+        self.viewers = set()
+        self.running = False
+        self.loop = None
+        self.stopped = None
+        self.start_error = None
+        self.frame_number = 0
+
+        # Same seeding as Simulation.restart_simulation so seeds give the same result
+        try:
+            seed_val = int(kwargs.get('initial_seed'))
+        except (TypeError, ValueError):
+            seed_val = random.randint(0, 99999)
+
+        np.random.seed(seed_val)
+        random.seed(seed_val)
+
+        num_types = kwargs.get('initial_num_types')
+        interaction_matrix = np.random.uniform(-1.0, 1.0, (num_types, num_types)) * 1.5
+
+        self.manager = manager_from_config(kwargs, interaction_matrix)
+
+    # --------------------------------------------------------------------------------------
+    # Physics side
+
+    def physics_loop(self):
+        # Runs the simulation and hands a snapshot of every frame to the asyncio loop.
+        # The copy is the only extra work done on the physics thread, and only
+        # when a viewer is connected
+        frame_time = 1.0 / self.max_fps if self.max_fps else 0.0
+
+        while self.running:
+            start = time.perf_counter()
+
+            positions, types, _ = self.manager.update()
+            n = self.manager.particle_count
+
+            if self.viewers:
+                snapshot = Snapshot(
+                    self.frame_number,
+                    self.manager.ids[:n].copy(),
+                    positions.copy(),
+                    types.copy()
+                )
+                self.loop.call_soon_threadsafe(self.publish, snapshot)
+            self.frame_number += 1
+
+            elapsed = time.perf_counter() - start
+            if elapsed < frame_time:
+                time.sleep(frame_time - elapsed)
+
+    # --------------------------------------------------------------------------------------
+    # Asyncio side
+
+    def publish(self, snapshot):
+        # Give the snapshot to every viewer, replacing the one they didn't get to yet
+        for viewer in self.viewers:
+            if viewer.pending is not None:
+                viewer.frames_dropped += 1
+            viewer.pending = snapshot
+            viewer.new_frame.set()
+
+    def can_delta(self, viewer, snapshot):
+        # Delta frames need the same particles in the same order with the same types
+        last = viewer.last_sent
+        if last is None or viewer.frames_sent % self.keyframe_interval == 0:
+            return False
+        return (
+            len(last.ids) == len(snapshot.ids)
+            and np.array_equal(last.ids, snapshot.ids)
+            and np.array_equal(last.types, snapshot.types)
+        )
+
+    async def handle_viewer(self, reader, writer):
+        viewer = Viewer(writer)
+        self.viewers.add(viewer)
+
+        try:
+            while self.running:
+                await viewer.new_frame.wait()
+                viewer.new_frame.clear()
+                if viewer.pending is None:
+                    continue
+
+                snapshot, viewer.pending = viewer.pending, None
+                snapshot.prepare(self.map_size)
+                previous = viewer.last_sent.quantized if self.can_delta(viewer, snapshot) else None
+
+                writer.write(encode_frame(
+                    snapshot.frame_number, snapshot.quantized, snapshot.types, self.map_size, previous
+                ))
+                await writer.drain()
+
+                viewer.last_sent = snapshot
+                viewer.frames_sent += 1
+
+                # Wait until the viewer has the frame, snapshots published in
+                # the meantime replace each other in 'pending'
+                if await reader.readexactly(len(ACK)) != ACK:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.viewers.discard(viewer)
+            writer.close()
+
+    async def serve(self, started):
+        # Runs the network side until stop() is called. 'started' is always set,
+        # when the server couldn't start the error is kept in 'start_error'
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+
+        try:
+            server = await asyncio.start_server(self.handle_viewer, self.host, self.port)
+        except OSError as error:
+            self.start_error = error
+            return
+        finally:
+            started.set()
+
+        print(f"Streaming on {self.host}:{self.port}")
+
+        await self.stopped.wait()
+
+        # Wake up the viewers so their handlers end
+        for viewer in list(self.viewers):
+            viewer.writer.close()
+            viewer.new_frame.set()
+
+        server.close()
+        await server.wait_closed()
+
+    def stop(self):
+        # Can be called from any thread, run() returns after the current frame
+        self.running = False
+
+    def run(self):
+        # The asyncio loop gets its own thread and the physics runs on the calling thread,
+        # Numba's parallel kernels are best launched from the main thread
+        self.running = True
+        started = threading.Event()
+        network = threading.Thread(target=lambda: asyncio.run(self.serve(started)), daemon=True)
+        network.start()
+        started.wait()
+
+        # For example when the port is already in use
+        if self.start_error is not None:
+            self.running = False
+            network.join()
+            raise self.start_error
+
+        try:
+            self.physics_loop()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # The physics loop is done so nothing gets published anymore
+            self.running = False
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            network.join()
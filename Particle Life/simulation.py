@@ -2,9 +2,13 @@ from numba.misc.appdirs import unicode
 import pygame
 import numpy as np
 import random
-from particleManager import ParticleManager
+from particleManager import manager_from_config
+from forceLaws import FORCE_LAWS
 from visualization import *
 
+# The number of particles spawned with a single click on the map
+SPAWN_COUNT = 50
+
 class Simulation:
     def __init__(self, **kwargs):
         # Use passed variables to configure the simulation
@@ -34,6 +38,8 @@ class Simulation:
 
     def load_config(self, cfg):
         # Use the configuration variables to set all local variables
+        # (the whole configuration is kept for the Particle Manager)
+        self.config         = cfg
         self.particle_count = cfg.get('particle_count')
         self.map_size       = cfg.get('map_size')
         self.min_r          = cfg.get('min_r')
@@ -42,6 +48,8 @@ class Simulation:
         self.friction       = cfg.get('friction')
         self.delta_time     = cfg.get('delta_time')
         self.max_speed      = cfg.get('max_speed')
+        self.force_law      = cfg.get('force_law', 'sine')
+        self.render_threads = cfg.get('render_threads')
         self.sidebar_width  = cfg.get('sidebar_width')
         self.screen_size    = (cfg.get('screen_width'), cfg.get('screen_height'))
         self.num_types      = cfg.get('initial_num_types')
@@ -79,21 +87,20 @@ class Simulation:
         np.random.seed(seed_val)
         random.seed(seed_val)
         
-        # Using the seed initialize a new interaction matrix and Particle Manager
+        # Using the seed initialize a new interaction matrix
         self.interaction_matrix = np.random.uniform(-1.0, 1.0, (self.num_types, self.num_types)) * 1.5
         
-        self.manager = ParticleManager(
-            particle_count=self.particle_count,
-            map_size=self.map_size,
-            num_types=self.num_types,
-            min_r=self.min_r,
-            max_r=self.max_r,
-            cell_size=self.cell_size,
-            interaction_matrix=self.interaction_matrix,
-            friction=self.friction,
-            dt=self.delta_time,
-            max_speed=self.max_speed
-        )
+        # The Particle Manager is only created once, after that we reset it in
+        # place so no buffers get reallocated
+        if self.manager is None:
+            self.manager = manager_from_config(
+                self.config, self.interaction_matrix,
+                particle_count=self.particle_count,
+                max_types=len(self.colors),
+                force_law=self.force_law
+            )
+        else:
+            self.manager.reset(self.interaction_matrix, self.particle_count)
 
         # Clear the buffer to remove previous coloured pixels
         self.pixel_buffer[:, :] = np.array(self.BG_COLOR, dtype=np.uint8)
@@ -111,6 +118,7 @@ class Simulation:
             
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 self.on_click(event.pos)
+                self.on_map_click(event.pos, event.button)
                 
             elif event.type == pygame.KEYDOWN:
                 self.on_keypress(event)
@@ -159,6 +167,37 @@ class Simulation:
         if self.ui_rects.get('fancy', pygame.Rect(0,0,0,0)).collidepoint(mx, my):
             self.fancy = not self.fancy
 
+        if self.ui_rects.get('force_law', pygame.Rect(0,0,0,0)).collidepoint(mx, my):
+            # Go to the next registered force law, this doesn't restart the simulation
+            names = list(FORCE_LAWS)
+            self.force_law = names[(names.index(self.force_law) + 1) % len(names)]
+            self.manager.set_force_law(self.force_law)
+
+
+    def on_map_click(self, pos, button):
+        # Clicking on the map edits the population in place:
+        # left click spawns a small cloud, right click removes particles around the cursor
+        mx, my = pos
+        if mx >= self.map_size * 2 or my >= self.map_size * 2:
+            return
+
+        # The map is drawn at twice the size
+        center = np.array([mx / 2, my / 2])
+        radius = self.cell_size / 2
+
+        if button == 1:
+            offsets = np.random.uniform(-radius, radius, (SPAWN_COUNT, 2))
+            # The manager's type count, self.num_types is the sidebar's count for the next restart
+            types = np.random.randint(0, self.manager.num_types, SPAWN_COUNT)
+            self.manager.spawn(center + offsets, types)
+
+        elif button == 3:
+            n = self.manager.particle_count
+            delta = self.manager.pos[:n] - center
+            
+            # Toroidal distance correction
+            delta = (delta + self.map_size / 2) % self.map_size - self.map_size / 2
+            self.manager.despawn(np.nonzero((delta ** 2).sum(axis=1) < radius ** 2)[0])
 
     def on_keypress(self, event):
 
@@ -196,7 +235,9 @@ class Simulation:
             # Limit framerate and display it as
             # the window title
             self.clock.tick(60)
-            pygame.display.set_caption(f"Particle Life | FPS: {self.clock.get_fps():.1f}")
+            pygame.display.set_caption(
+                f"Particle Life | FPS: {self.clock.get_fps():.1f} | Substeps: {self.manager.substeps}"
+            )
             
         pygame.quit()
 
@@ -210,7 +251,7 @@ class Simulation:
         draw_simulation(
             self.screen, self.particle_surface, self.pixel_buffer,
             positions, types, self.colors, self.map_size,
-            self.buffer_clear, self.fancy, self.BG_COLOR
+            self.buffer_clear, self.fancy, self.BG_COLOR, self.render_threads
         )
         
         # 2. UI Panel
@@ -221,7 +262,7 @@ class Simulation:
         )
 
         self.ui_rects = self.ui_rects | draw_ui_2(
-            self.screen, self.map_size, self.sidebar_width, self.fancy
+            self.screen, self.map_size, self.sidebar_width, self.fancy, self.force_law
         )
       
         
@@ -0,0 +1,39 @@
+from contextlib import contextmanager
+import numba
+from numba import config
+
+# ---------------------------------------------------------------------------------
+# Thread control
+#
+# Numba has a single thread pool (NUMBA_NUM_THREADS threads, fixed at import), but the
+# number of threads a parallel kernel uses can be changed per call. The physics and the
+# rendering each get their own count.
+
+THREADING_LAYERS = ("default", "safe", "threadsafe", "forksafe", "tbb", "omp", "workqueue")
+
+
+def configure_threading(layer="default"):
+    # Picks the Numba threading layer, this only works before the first parallel kernel runs.
+    # "default" lets Numba choose, so a NUMBA_THREADING_LAYER from the environment still works
+    if layer not in THREADING_LAYERS:
+        raise ValueError(f"Unknown threading layer '{layer}', use one of {THREADING_LAYERS}")
+    if layer != "default":
+        config.THREADING_LAYER = layer
+
+
+def clamp_threads(threads):
+    # None or 0 means all threads of the pool
+    if not threads:
+        return config.NUMBA_NUM_THREADS
+    return min(max(int(threads), 1), config.NUMBA_NUM_THREADS)
+
+
+@contextmanager
+def use_threads(threads):
+    # Runs the parallel kernels inside the 'with' block with 'threads' threads
+    previous = numba.get_num_threads()
+    numba.set_num_threads(clamp_threads(threads))
+    try:
+        yield
+    finally:
+        numba.set_num_threads(previous)
@@ -0,0 +1,80 @@
+import socket
+import sys
+import numpy as np
+import pygame
+from server import FrameDecoder, LENGTH, ACK
+from visualization import draw_simulation
+
+# A minimal remote viewer for the StreamServer, usage: python viewer.py [host] [port]
+
+COLORS = [
+    (251, 150, 72), (255, 255, 255), (250, 251, 255),
+    (173, 198, 223), (170, 210, 160), (212, 0, 30),
+    (212, 255, 0), (100, 150, 100), (200, 150, 100), (100, 150, 200)
+]
+
+
+def recv_exactly(sock, size):
+    # Blocks until 'size' bytes are received
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+def receive_frame(sock, decoder):
+    # Reads and decodes the next frame, then tells the server we are ready for the next one
+    (length,) = LENGTH.unpack(recv_exactly(sock, LENGTH.size))
+    positions, types = decoder.decode(recv_exactly(sock, length))
+    sock.sendall(ACK)
+    return positions, types
+
+
+def main():
+    host = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5555
+
+    decoder = FrameDecoder()
+    try:
+        sock = socket.create_connection((host, port))
+
+        # The first frame tells us the map size
+        positions, types = receive_frame(sock, decoder)
+    except ConnectionError as error:
+        print(f"Could not connect to {host}:{port}: {error}")
+        return
+
+    map_size = int(decoder.map_size)
+
+    pygame.init()
+    screen = pygame.display.set_mode((map_size * 2, map_size * 2))
+    surface = pygame.Surface((map_size * 2, map_size * 2), depth=24)
+    pixel_buffer = np.zeros((map_size, map_size, 3), dtype=np.uint8)
+    clock = pygame.time.Clock()
+
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+
+        draw_simulation(screen, surface, pixel_buffer, positions, types, COLORS, map_size, True, False, (0, 0, 0))
+        pygame.display.flip()
+        clock.tick()
+        pygame.display.set_caption(f"Particle Life Viewer | Frame: {decoder.frame_number} | FPS: {clock.get_fps():.1f}")
+
+        try:
+            positions, types = receive_frame(sock, decoder)
+        except ConnectionError:
+            print("The server stopped")
+            running = False
+
+    sock.close()
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import pygame
 import numpy as np
 import cv2
 from numba import njit, prange
+from threadControl import use_threads
 import matplotlib.pyplot as plt
 import matplotlib.backends.backend_agg as agg
 
@@ -98,7 +99,7 @@ def draw_ui(screen, map_size, sidebar_width, seed_text, input_active, num_types,
 
     return ui_rects, y_cursor + 60
 
-def draw_ui_2(screen, map_size, sidebar_width, fancy):
+def draw_ui_2(screen, map_size, sidebar_width, fancy, force_law):
 
     # Another UI drawer in another function
 
@@ -142,6 +143,13 @@ def draw_ui_2(screen, map_size, sidebar_width, fancy):
     
     y_cursor += 45
 
+    # Cycles through the registered force laws
+    force_law_rect = pygame.Rect(x_start, y_cursor, 120, 30)
+    draw_button(screen, force_law_rect, force_law.upper(), font, bg_color=(55, 55, 55))
+    ui_rects['force_law'] = force_law_rect
+
+    y_cursor += 45
+
  
     
     return ui_rects
@@ -221,8 +229,9 @@ def draw_particles_fast(pixel_buffer, positions, types, colors, num_colors):
         y = positions[i, 1]
         p_type = types[i]
         
-        x = int(x)
-        y = int(y)
+        # 'x % map_size' can round up to map_size, keep it on the buffer
+        x = min(int(x), pixel_buffer.shape[1] - 1)
+        y = min(int(y), pixel_buffer.shape[0] - 1)
         
         color = colors[p_type % num_colors]
         
@@ -232,7 +241,7 @@ def draw_particles_fast(pixel_buffer, positions, types, colors, num_colors):
 
 
  
-def draw_simulation(screen, surface, pixel_buffer, positions, types, colors, map_size, buffer_clear, fancy, bg_color=(20, 20, 20)):
+def draw_simulation(screen, surface, pixel_buffer, positions, types, colors, map_size, buffer_clear, fancy, bg_color=(20, 20, 20), render_threads=None):
      
     # The function which optionally clears the screen and then draws all particles to the surface
     # and blits it onto the screen
@@ -243,13 +252,15 @@ def draw_simulation(screen, surface, pixel_buffer, positions, types, colors, map
     colors_np = np.array(colors, dtype=np.uint8)
     num_colors = len(colors)
     
-    draw_particles_fast(
-        pixel_buffer, 
-        positions, 
-        types, 
-        colors_np, 
-        num_colors
-    )
+    # The rendering gets its own thread count so it doesn't compete with the physics
+    with use_threads(render_threads):
+        draw_particles_fast(
+            pixel_buffer, 
+            positions, 
+            types, 
+            colors_np, 
+            num_colors
+        )
     # Lot of experimenting with the values. Don't know why it works now
     # but looks fancier
     if fancy: